@@ -3,8 +3,17 @@
 import streamlit as st
 import pandas as pd
 import os
+import io
+import hashlib
 import zipfile
 import tempfile
+import pickle
+import shutil
+import atexit
+import threading
+import uuid
+import weakref
+from collections import OrderedDict, Counter
 from datetime import datetime, date
 import csv  # para escritura robusta de CSV
 
@@ -16,6 +25,7 @@ import geopandas as gpd
 from shapely.geometry import Point
 from streamlit_folium import st_folium
 import folium
+import branca.colormap
 
 # === TÍTULO / CONFIG ===
 st.set_page_config(page_title="Encuesta proyectos DNR", layout="wide")
@@ -34,6 +44,7 @@ os.makedirs(GEOM_DIR, exist_ok=True)
 USERS_PATH = "users_12.csv"  # respaldo local solo para desarrollo
 RESP_CSV   = os.path.join(RESP_DIR, "respuestas.csv")
 GEO_CSV    = os.path.join(RESP_DIR, "respuestas_geo.csv")
+UPLOADS_INDEX_CSV = os.path.join(RESP_DIR, "uploads_index.csv")  # hash de contenido -> ruta en Dropbox
 
 AOI_GEOJSON = os.path.join(AOI_DIR, "aoi.geojson")
 
@@ -51,8 +62,6 @@ if "muni_sel" not in st.session_state:
 if "_mun_sel_all" not in st.session_state:
     st.session_state._mun_sel_all = False
 
-if "uploaded_geom" not in st.session_state:
-    st.session_state.uploaded_geom = None
 if "lonlat_pt" not in st.session_state:
     st.session_state.lonlat_pt = (None, None)
 if "mun_detectados" not in st.session_state:
@@ -109,31 +118,106 @@ def _join_path(*parts):
 def dropbox_upload_or_update(local_path, dest_name=None, dest_folder=None):
     if not os.path.exists(local_path):
         return None, "archivo local no existe"
+    if dest_name is None:
+        dest_name = os.path.basename(local_path)
+    with open(local_path, "rb") as f:
+        return dropbox_upload_bytes(f.read(), dest_name, dest_folder=dest_folder)
+
+def dropbox_upload_bytes(data, dest_name, dest_folder=None):
     if dest_folder is None:
         dest_folder = st.secrets.get("dropbox_folder", "/ENCUESTA DNR FINAL")
     if not dest_folder.startswith("/"):
         dest_folder = "/" + dest_folder
-    if dest_name is None:
-        dest_name = os.path.basename(local_path)
     dbx = _dbx()
     _ensure_folder(dbx, dest_folder)
     subdir = os.path.dirname(dest_name).strip("/")
     if subdir:
         _ensure_folder(dbx, _join_path(dest_folder, subdir))
     dest_path = _join_path(dest_folder, dest_name)
-    with open(local_path, "rb") as f:
-        try:
-            dbx.files_upload(f.read(), dest_path, mode=dropbox.files.WriteMode("overwrite"), mute=True)
-        except AuthError as e:
-            raise RuntimeError(f"AuthError de Dropbox: {e}") from e
-        except ApiError as e:
-            raise RuntimeError(f"ApiError de Dropbox: {e}") from e
+    try:
+        dbx.files_upload(data, dest_path, mode=dropbox.files.WriteMode("overwrite"), mute=True)
+    except AuthError as e:
+        raise RuntimeError(f"AuthError de Dropbox: {e}") from e
+    except ApiError as e:
+        raise RuntimeError(f"ApiError de Dropbox: {e}") from e
     try:
         tlink = dbx.files_get_temporary_link(dest_path).link
     except Exception:
         tlink = None
     return tlink, "uploaded"
 
+# --------- Subidas direccionadas por contenido ----------
+DROPBOX_HASH_BLOCK = 4 * 1024 * 1024
+
+def dropbox_content_hash(data):
+    """Mismo hash que expone Dropbox en `content_hash`: SHA-256 de la concatenación
+    de los SHA-256 de cada bloque de 4 MB."""
+    mv = memoryview(data)
+    h = hashlib.sha256()
+    for i in range(0, len(mv), DROPBOX_HASH_BLOCK):
+        h.update(hashlib.sha256(mv[i:i + DROPBOX_HASH_BLOCK]).digest())
+    return h.hexdigest()
+
+@st.cache_resource
+def _uploads_index_lock():
+    # El script se re-ejecuta en cada rerun: el lock debe vivir en la caché del proceso
+    return threading.Lock()
+
+def _read_uploads_index():
+    if os.path.exists(UPLOADS_INDEX_CSV) and os.path.getsize(UPLOADS_INDEX_CSV) > 0:
+        try:
+            idx = pd.read_csv(UPLOADS_INDEX_CSV, dtype=str)
+            return dict(zip(idx["content_hash"], idx["dropbox_path"]))  # la última fila gana
+        except Exception:
+            pass
+    return {}
+
+def _load_uploads_index():
+    with _uploads_index_lock():
+        return _read_uploads_index()
+
+def _set_uploads_index(content_hash, dropbox_path):
+    """Registra hash -> ruta si difiere de la entrada vigente (append; la última fila gana)."""
+    with _uploads_index_lock():
+        if _read_uploads_index().get(content_hash) == dropbox_path:
+            return
+        row = pd.DataFrame([{"content_hash": content_hash, "dropbox_path": dropbox_path}])
+        if os.path.exists(UPLOADS_INDEX_CSV):
+            row.to_csv(UPLOADS_INDEX_CSV, mode="a", header=False, index=False)
+        else:
+            row.to_csv(UPLOADS_INDEX_CSV, index=False)
+
+def dropbox_upload_dedup(data, nombre, dest_folder=None):
+    """Sube `data` a uploads/sha/<hash><ext> solo si ese contenido no está ya en Dropbox.
+    Devuelve (ruta en Dropbox, link temporal, estado)."""
+    if dest_folder is None:
+        dest_folder = st.secrets.get("dropbox_folder", "/ENCUESTA DNR FINAL")
+    content_hash = dropbox_content_hash(data)
+    dest_name = f"uploads/sha/{content_hash}{os.path.splitext(nombre)[1].lower()}"
+    canon_path = _join_path(dest_folder, dest_name)
+    idx = _load_uploads_index()
+    candidatos = [idx[content_hash]] if content_hash in idx else []
+    if canon_path not in candidatos:
+        candidatos.append(canon_path)
+    dbx = _dbx()
+    for path in candidatos:
+        try:
+            md = dbx.files_get_metadata(path)
+        except Exception:
+            continue
+        if getattr(md, "content_hash", None) == content_hash:
+            if idx.get(content_hash) != path:
+                _set_uploads_index(content_hash, path)
+            try:
+                tlink = dbx.files_get_temporary_link(path).link
+            except Exception:
+                tlink = None
+            return path, tlink, "existente"
+    tlink, status = dropbox_upload_bytes(data, dest_name, dest_folder=dest_folder)
+    if idx.get(content_hash) != canon_path:
+        _set_uploads_index(content_hash, canon_path)
+    return canon_path, tlink, status
+
 # --------- Utilidades ----------
 @st.cache_data
 def load_users(path=None):
@@ -157,6 +241,8 @@ def auth(df_users, u, p):
     return None
 
 def save_response(row_dict):
+    vistas = _vistas()  # se construyen antes del append para no aplicar la fila dos veces
+    huella_antes = _huella_datos()
     df = pd.DataFrame([row_dict])
     for c in COLUMNS_SCHEMA:
         if c not in df.columns:
@@ -168,13 +254,17 @@ def save_response(row_dict):
         df.to_csv(RESP_CSV, mode="a", header=False, index=False, encoding="utf-8", lineterminator="\n", quoting=csv.QUOTE_MINIMAL)
     else:
         df.to_csv(RESP_CSV, index=False, encoding="utf-8", lineterminator="\n", quoting=csv.QUOTE_MINIMAL)
+    vistas.registrar_respuesta(df.iloc[0].to_dict(), huella_antes, _huella_datos())
 
 def save_geo_point(username, lon, lat, ts):
+    vistas = _vistas()
+    huella_antes = _huella_datos()
     gdf = pd.DataFrame([{"timestamp": ts, "username": username, "lon": float(lon) if lon is not None else None, "lat": float(lat) if lat is not None else None}])
     if os.path.exists(GEO_CSV):
         gdf.to_csv(GEO_CSV, mode="a", header=False, index=False)
     else:
         gdf.to_csv(GEO_CSV, index=False)
+    vistas.registrar_punto(gdf.iloc[0].to_dict(), huella_antes, _huella_datos())
 
 @st.cache_data
 def load_aoi():
@@ -241,12 +331,15 @@ def _gpd_read(path):
 def read_geo_upload(uploaded_file):
     suffix = os.path.splitext(uploaded_file.name.lower())[1]
     with tempfile.TemporaryDirectory() as td:
-        fpath = os.path.join(td, uploaded_file.name)
-        with open(fpath, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        if suffix == ".zip":
-            with zipfile.ZipFile(fpath, 'r') as zf:
+        if suffix in [".zip", ".kmz"]:
+            # Se extrae directo desde memoria, sin copiar el buffer crudo a disco
+            with zipfile.ZipFile(io.BytesIO(uploaded_file.getbuffer()), 'r') as zf:
                 zf.extractall(td)
+        else:
+            fpath = os.path.join(td, uploaded_file.name)
+            with open(fpath, "wb") as f:
+                f.write(uploaded_file.getbuffer())
+        if suffix == ".zip":
             shp = None
             for root, _, files in os.walk(td):
                 for fn in files:
@@ -258,8 +351,6 @@ def read_geo_upload(uploaded_file):
             gdf = _gpd_read(shp)
         elif suffix in [".kmz", ".kml"]:
             if suffix == ".kmz":
-                with zipfile.ZipFile(fpath, 'r') as zf:
-                    zf.extractall(td)
                 kml_path = None
                 for root, _, files in os.walk(td):
                     for fn in files:
@@ -279,6 +370,93 @@ def read_geo_upload(uploaded_file):
             gdf = gdf.to_crs(4326)
         return gdf
 
+# === Geometrías subidas por sesión: memoria acotada + derrame a disco ===
+GEOM_SESION_TOLERANCIA = 0.0001                  # simplificación (~10 m en grados)
+GEOM_SESION_SPILL_BYTES = 2 * 1024 * 1024        # por sesión: sobre esto va directo a disco
+GEOM_SESION_BUDGET_BYTES = 64 * 1024 * 1024      # memoria total entre todas las sesiones
+
+class SessionGeomStore:
+    """Guarda la geometría subida de cada sesión como WKB simplificado (sin atributos).
+    Las entradas grandes van directo a un directorio temporal y, si la memoria total
+    supera el presupuesto, se bajan a disco las de uso menos reciente (LRU)."""
+
+    def __init__(self, budget_bytes, spill_bytes, tolerancia):
+        self.budget_bytes = budget_bytes
+        self.spill_bytes = spill_bytes
+        self.tolerancia = tolerancia
+        self._dir = tempfile.mkdtemp(prefix="dnr_geom_")
+        atexit.register(shutil.rmtree, self._dir, True)
+        self._mem = OrderedDict()  # key -> (lista de WKB, bytes)
+        self._mem_bytes = 0
+        self._disk = {}            # key -> ruta del archivo
+        self._lock = threading.Lock()
+
+    def _spill(self, key, wkb):
+        path = os.path.join(self._dir, f"{key}.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(wkb, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._disk[key] = path
+
+    def _drop(self, key):
+        if key in self._mem:
+            _, size = self._mem.pop(key)
+            self._mem_bytes -= size
+        path = self._disk.pop(key, None)
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def put(self, key, gdf):
+        wkb = gdf.geometry.simplify(self.tolerancia, preserve_topology=True).to_wkb().tolist()
+        size = sum(len(b) for b in wkb if b is not None)
+        with self._lock:
+            self._drop(key)
+            if size > self.spill_bytes:
+                self._spill(key, wkb)
+                return
+            self._mem[key] = (wkb, size)
+            self._mem_bytes += size
+            while self._mem_bytes > self.budget_bytes and len(self._mem) > 1:
+                old_key, (old_wkb, old_size) = self._mem.popitem(last=False)
+                self._mem_bytes -= old_size
+                self._spill(old_key, old_wkb)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                wkb = self._mem[key][0]
+            elif key in self._disk:
+                with open(self._disk[key], "rb") as f:
+                    wkb = pickle.load(f)
+            else:
+                return None
+        return gpd.GeoDataFrame(geometry=gpd.GeoSeries.from_wkb(wkb, crs=4326))
+
+    def has(self, key):
+        with self._lock:
+            return key in self._mem or key in self._disk
+
+    def discard(self, key):
+        with self._lock:
+            self._drop(key)
+
+@st.cache_resource
+def _geom_store():
+    return SessionGeomStore(GEOM_SESION_BUDGET_BYTES, GEOM_SESION_SPILL_BYTES, GEOM_SESION_TOLERANCIA)
+
+class _GeomSessionToken:
+    """Vive en st.session_state; al recolectarse la sesión libera su geometría del almacén."""
+
+geom_store = _geom_store()
+if "_geom_key" not in st.session_state:
+    st.session_state._geom_key = uuid.uuid4().hex
+    st.session_state._geom_token = _GeomSessionToken()
+    weakref.finalize(st.session_state._geom_token, geom_store.discard, st.session_state._geom_key)
+geom_key = st.session_state._geom_key
+
 def municipios_por_interseccion(gdf_geom, mun_gdf, name_col):
     try:
         inter = gpd.sjoin(gdf_geom, mun_gdf[[name_col, 'geometry']], how="inner", predicate="intersects")
@@ -287,6 +465,59 @@ def municipios_por_interseccion(gdf_geom, mun_gdf, name_col):
     except Exception:
         return []
 
+# === Capa coroplética por municipio ===
+@st.cache_data
+def load_municipios_simplificados(tolerancia=0.001):
+    """Geometrías de municipios simplificadas (solo nombre + geometría) para el mapa general.
+    Devuelve (gdf, name_col); gdf es None si no hay límites cargados."""
+    gdf, _, name_col = load_municipios_car_auto()
+    if gdf is None:
+        return None, name_col
+    gdf = gdf[[name_col, "geometry"]].copy()
+    gdf[name_col] = gdf[name_col].astype(str)
+    gdf["geometry"] = gdf.geometry.simplify(tolerancia, preserve_topology=True)
+    return gdf, name_col
+
+@st.cache_data(max_entries=1)
+def agregado_por_municipio(_df_latest, version):
+    """Inversión total, número de proyectos y avance promedio por municipio (últimas respuestas).
+    El costo de cada proyecto se reparte en partes iguales entre sus municipios."""
+    cols = ["municipio", "inversion_total", "n_proyectos", "avance_prom"]
+    if _df_latest.empty:
+        return pd.DataFrame(columns=cols)
+    d = _df_latest[["proyecto_nombre", "municipios_proyecto", "costo_proyecto_cop", "avance_proyecto_pct"]].reset_index(drop=True)
+    d["costo"] = pd.to_numeric(d["costo_proyecto_cop"], errors="coerce")
+    d["avance"] = pd.to_numeric(d["avance_proyecto_pct"], errors="coerce")
+    d["municipio"] = d["municipios_proyecto"].fillna("").astype(str).str.split(";")
+    d = d.explode("municipio")
+    d["municipio"] = d["municipio"].str.strip()
+    d = d[d["municipio"] != ""]
+    if d.empty:
+        return pd.DataFrame(columns=cols)
+    d["inversion"] = d["costo"] / d.groupby(level=0)["municipio"].transform("size")
+    agg = d.groupby("municipio").agg(
+        inversion_total=("inversion", "sum"),
+        n_proyectos=("proyecto_nombre", "nunique"),
+        avance_prom=("avance", "mean"),
+    ).reset_index()
+    return agg[cols]
+
+@st.cache_data(max_entries=1)
+def capa_municipios_geojson(_df_latest, version):
+    """GeoJSON de municipios con los agregados unidos; None si no hay límites cargados."""
+    mun_simpl, name_col = load_municipios_simplificados()
+    if mun_simpl is None:
+        return None
+    # Clave renombrada para no chocar con name_col cuando este se llama "municipio"
+    agg = agregado_por_municipio(_df_latest, version).rename(columns={"municipio": "_mun"})
+    gdf = mun_simpl.merge(agg, how="left", left_on=name_col, right_on="_mun").drop(columns="_mun")
+    gdf["inversion_total"] = gdf["inversion_total"].fillna(0.0)
+    gdf["n_proyectos"] = gdf["n_proyectos"].fillna(0).astype(int)
+    gdf["avance_prom"] = gdf["avance_prom"].round(1)
+    gdf["inversion_txt"] = gdf["inversion_total"].map(_fmt_cop)
+    vmax = float(gdf["inversion_total"].max()) if len(gdf) else 0.0
+    return gdf.to_json(na="null"), name_col, vmax
+
 # === Helper para Folium: eliminar columnas datetime antes de serializar ===
 def _drop_datetime_cols_for_folium(gdf):
     import pandas as pd
@@ -320,6 +551,163 @@ def _read_csv_robusto(path):
     except Exception:
         return pd.DataFrame(columns=COLUMNS_SCHEMA)
 
+def load_historial():
+    if os.path.exists(RESP_CSV) and os.path.getsize(RESP_CSV) > 0:
+        df = _read_csv_robusto(RESP_CSV)
+        for c in COLUMNS_SCHEMA:
+            if c not in df.columns:
+                df[c] = pd.NA
+        df = df[COLUMNS_SCHEMA]
+        if "timestamp" in df.columns:
+            df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce")
+        return df.sort_values("timestamp", na_position="first")
+    return pd.DataFrame(columns=COLUMNS_SCHEMA)
+
+@st.cache_data(max_entries=1)
+def load_historial_cacheado(huella):
+    """Historial completo para la tabla; solo se vuelve a leer si cambia la huella de los CSV."""
+    return load_historial()
+
+def _huella_archivo(path):
+    try:
+        stt = os.stat(path)
+        return (stt.st_size, stt.st_mtime_ns)
+    except OSError:
+        return None
+
+def _huella_datos():
+    """Tamaño y mtime de respuestas.csv y respuestas_geo.csv."""
+    return (_huella_archivo(RESP_CSV), _huella_archivo(GEO_CSV))
+
+def load_puntos_geo():
+    if os.path.exists(GEO_CSV) and os.path.getsize(GEO_CSV) > 0:
+        g = pd.read_csv(GEO_CSV)
+        if "timestamp" in g.columns:
+            g["timestamp"] = pd.to_datetime(g["timestamp"], errors="coerce")
+            return g.sort_values("timestamp", na_position="first")
+    return pd.DataFrame(columns=["timestamp", "username", "lon", "lat"])
+
+# --- Vistas materializadas (se mantienen al escribir, no en cada rerun)
+def _municipios_de(valor):
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return []
+    return [x.strip() for x in str(valor).split(";") if x.strip()]
+
+def _clave(valor):
+    # Todos los faltantes (NaN/None) comparten una clave, como en drop_duplicates
+    return None if valor is None or pd.isna(valor) else valor
+
+class VistasRespuestas:
+    """Última respuesta por usuario y por proyecto, conjunto de municipios y sumas de KPIs.
+    Se construye una vez desde el historial y luego se actualiza en cada guardado.
+    `huella` es la de los CSV que reflejan las vistas; `version` cambia con cada actualización."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limpiar()
+
+    def _limpiar(self):
+        self.version = uuid.uuid4().hex
+        self.huella = None
+        self.ultima_por_usuario = {}   # username -> fila
+        self.ultima_por_proyecto = {}  # proyecto_nombre -> fila
+        self.punto_por_usuario = {}    # username -> (lon, lat)
+        self.mun_conteo = Counter()    # municipio -> nº de últimas respuestas que lo incluyen
+        self.suma_avance = 0.0
+        self.n_avance = 0
+        self._df_cache = {}
+
+    def _sumar(self, fila, signo):
+        for m in _municipios_de(fila.get("municipios_proyecto")):
+            self.mun_conteo[m] += signo
+            if self.mun_conteo[m] <= 0:
+                del self.mun_conteo[m]
+        try:
+            avance = float(fila.get("avance_proyecto_pct"))
+        except (TypeError, ValueError):
+            avance = None
+        if avance is not None and pd.notna(avance):
+            self.suma_avance += signo * avance
+            self.n_avance += signo
+
+    def _aplicar(self, fila):
+        fila = dict(fila)
+        fila["timestamp"] = pd.to_datetime(fila.get("timestamp"), errors="coerce")
+        u = _clave(fila.get("username"))
+        prev = self.ultima_por_usuario.get(u)
+        if prev is not None:
+            self._sumar(prev, -1)
+        self.ultima_por_usuario[u] = fila
+        self._sumar(fila, +1)
+        self.ultima_por_proyecto[_clave(fila.get("proyecto_nombre"))] = fila
+
+    def reconstruir(self, df_hist, df_geo, huella):
+        """Recalcula todo desde el historial (ordenado por timestamp)."""
+        with self._lock:
+            self._limpiar()
+            for fila in df_hist.to_dict("records"):
+                self._aplicar(fila)
+            for p in df_geo.to_dict("records"):
+                self.punto_por_usuario[_clave(p.get("username"))] = (p.get("lon"), p.get("lat"))
+            self.huella = huella
+
+    def _reconstruir_desde_disco(self):
+        huella = _huella_datos()
+        self.reconstruir(load_historial(), load_puntos_geo(), huella)
+
+    def registrar_respuesta(self, fila, huella_antes, huella):
+        """Aplica la fila recién escrita; si los CSV ya no coincidían con las vistas
+        antes del append (editados por fuera), reconstruye desde disco."""
+        with self._lock:
+            if self.huella == huella_antes:
+                self._aplicar(fila)
+                self.version = uuid.uuid4().hex
+                self.huella = huella
+                self._df_cache = {}
+                return
+        self._reconstruir_desde_disco()
+
+    def registrar_punto(self, punto, huella_antes, huella):
+        with self._lock:
+            if self.huella == huella_antes:
+                self.punto_por_usuario[_clave(punto.get("username"))] = (punto.get("lon"), punto.get("lat"))
+                self.huella = huella
+                return
+        self._reconstruir_desde_disco()
+
+    @property
+    def n_usuarios(self):
+        # Igual que nunique(): sin contar usuario faltante
+        return len(self.ultima_por_usuario) - (None in self.ultima_por_usuario)
+
+    @property
+    def n_municipios(self):
+        return len(self.mun_conteo)
+
+    @property
+    def avance_promedio(self):
+        return self.suma_avance / self.n_avance if self.n_avance else None
+
+    def _df(self, nombre, filas):
+        with self._lock:
+            if nombre not in self._df_cache:
+                df = pd.DataFrame(list(filas.values()), columns=COLUMNS_SCHEMA)
+                self._df_cache[nombre] = df.sort_values("timestamp", na_position="first") if not df.empty else df
+            return self._df_cache[nombre]
+
+    def df_ultima_por_usuario(self):
+        return self._df("usuario", self.ultima_por_usuario)
+
+    def df_ultima_por_proyecto(self):
+        return self._df("proyecto", self.ultima_por_proyecto)
+
+@st.cache_resource
+def _vistas():
+    v = VistasRespuestas()
+    huella = _huella_datos()  # antes de leer: si cambia durante la lectura, se reconstruye luego
+    v.reconstruir(load_historial(), load_puntos_geo(), huella)
+    return v
+
 def sanitizar_respuestas_csv():
     try:
         if os.path.exists(RESP_CSV) and os.path.getsize(RESP_CSV) > 0:
@@ -336,7 +724,13 @@ def sanitizar_respuestas_csv():
     except Exception as e:
         st.warning(f"No se pudo sanitizar respuestas.csv: {e}")
 
-sanitizar_respuestas_csv()
+@st.cache_resource
+def _sanitizar_una_vez():
+    # Una vez por proceso: reescribir el CSV en cada rerun cambiaría su huella siempre
+    sanitizar_respuestas_csv()
+    return True
+
+_sanitizar_una_vez()
 
 if st.session_state.auth is None:
     with st.form("login"):
@@ -358,6 +752,7 @@ user = st.session_state.auth
 st.sidebar.success(f"Sesión: {user['name']} ({user['username']})")
 if st.sidebar.button("Cerrar sesión"):
     st.session_state.auth = None
+    geom_store.discard(geom_key)
     st.rerun()
 
 # Carga AOI y Municipios CAR
@@ -472,7 +867,7 @@ with st.form("encuesta_form"):
         else:
             try:
                 gdf = read_geo_upload(geo_file)
-                st.session_state.uploaded_geom = gdf
+                geom_store.put(geom_key, gdf)
                 try:
                     b = gdf.total_bounds
                     m_prev = folium.Map(location=[(b[1]+b[3])/2, (b[0]+b[2])/2], zoom_start=10)
@@ -536,15 +931,14 @@ if submitted and len(st.session_state.muni_sel) == 0:
 # Guardado (y subida a Dropbox si aplica)
 if submitted:
     ts = datetime.utcnow().isoformat()
-    ts_tag = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
 
-    uploaded_geom = st.session_state.uploaded_geom
-    if uploaded_geom is None and 'geo_file' in locals() and geo_file is not None:
+    tiene_geom = geom_store.has(geom_key)
+    if not tiene_geom and 'geo_file' in locals() and geo_file is not None:
         try:
-            uploaded_geom = read_geo_upload(geo_file)
-            st.session_state.uploaded_geom = uploaded_geom
+            geom_store.put(geom_key, read_geo_upload(geo_file))
+            tiene_geom = True
         except Exception:
-            uploaded_geom = None
+            tiene_geom = False
 
     lon_pt, lat_pt = st.session_state.lonlat_pt
 
@@ -556,12 +950,7 @@ if submitted:
     if 'geo_file' in locals() and geo_file is not None:
         try:
             archivo_geo_nombre = geo_file.name
-            drop_name = f"uploads/{user['username']}_{ts_tag}_{archivo_geo_nombre}"
-            tmp_path = os.path.join(tempfile.gettempdir(), f"{ts_tag}_{archivo_geo_nombre}")
-            with open(tmp_path, "wb") as f:
-                f.write(geo_file.getbuffer())
-            archivo_geo_link, _ = dropbox_upload_or_update(tmp_path, dest_name=drop_name, dest_folder=folder)
-            archivo_geo_dropbox_path = ("/" + folder.strip("/")) + "/" + drop_name.strip("/")
+            archivo_geo_dropbox_path, archivo_geo_link, _ = dropbox_upload_dedup(geo_file.getvalue(), archivo_geo_nombre, dest_folder=folder)
         except Exception as e:
             st.warning(f"No se pudo subir el archivo geográfico original: {e}")
 
@@ -581,7 +970,7 @@ if submitted:
         "costo_proyecto_cop": costo_proyecto,
         "avance_proyecto_pct": avance_proyecto,
         "comentario": comentario,
-        "modo_municipios": "archivo" if uploaded_geom is not None else "manual",
+        "modo_municipios": "archivo" if tiene_geom else "manual",
         "archivo_geo_nombre": archivo_geo_nombre or "",
         "archivo_geo_dropbox_path": archivo_geo_dropbox_path or "",
         "archivo_geo_link": archivo_geo_link or "",
@@ -604,30 +993,19 @@ if submitted:
     st.session_state._mun_sel_all = False
 
 # --------- Resultados / lectura robusta ----------
-def load_historial():
-    if os.path.exists(RESP_CSV) and os.path.getsize(RESP_CSV) > 0:
-        df = _read_csv_robusto(RESP_CSV)
-        for c in COLUMNS_SCHEMA:
-            if c not in df.columns:
-                df[c] = pd.NA
-        df = df[COLUMNS_SCHEMA]
-        if "timestamp" in df.columns:
-            df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce")
-        return df.sort_values("timestamp", na_position="first")
-    return pd.DataFrame(columns=COLUMNS_SCHEMA)
-
-def latest_by_user(df):
-    if df.empty:
-        return df
-    return df.sort_values("timestamp").drop_duplicates("username", keep="last")
-
+vistas = _vistas()
+huella = _huella_datos()
 try:
-    df_hist = load_historial()
+    df_hist = load_historial_cacheado(huella)
 except Exception as e:
     st.warning(f"No se pudo leer respuestas.csv (se omitieron líneas problemáticas): {e}")
     df_hist = pd.DataFrame(columns=COLUMNS_SCHEMA)
 
-df_latest = latest_by_user(df_hist)
+if huella != vistas.huella:
+    # Los CSV cambiaron por fuera de save_response/save_geo_point (p. ej. restaurados o editados)
+    vistas.reconstruir(df_hist, load_puntos_geo(), huella)
+
+df_latest = vistas.df_ultima_por_usuario()
 
 def _fmt_cop(v):
     try:
@@ -638,23 +1016,11 @@ def _fmt_cop(v):
 
 st.header("Resultados (última por usuario)")
 col1, col2, col3 = st.columns(3)
-if not df_latest.empty:
-    col1.metric("Usuarios con última respuesta", df_latest["username"].nunique())
-    if "municipios_proyecto" in df_latest.columns:
-        muni_total = set()
-        for s in df_latest["municipios_proyecto"].dropna():
-            for m in [x.strip() for x in str(s).split(";") if x.strip()]:
-                muni_total.add(m)
-        col2.metric("Municipios (últimas)", len(muni_total))
-    if "avance_proyecto_pct" in df_latest.columns:
-        try:
-            avance_prom = pd.to_numeric(df_latest["avance_proyecto_pct"], errors="coerce").mean()
-            if pd.notna(avance_prom):
-                col3.metric("Avance promedio", f"{avance_prom:.1f}%")
-            else:
-                col3.metric("Avance promedio", "—")
-        except Exception:
-            col3.metric("Avance promedio", "—")
+if vistas.n_usuarios:
+    col1.metric("Usuarios con última respuesta", vistas.n_usuarios)
+    col2.metric("Municipios (últimas)", vistas.n_municipios)
+    avance_prom = vistas.avance_promedio
+    col3.metric("Avance promedio", f"{avance_prom:.1f}%" if avance_prom is not None else "—")
 else:
     st.info("Aún no hay respuestas.")
 
@@ -694,6 +1060,26 @@ m = folium.Map(location=[CUNDINAMARCA_CENTER_LAT, CUNDINAMARCA_CENTER_LON], zoom
 if aoi_gdf is not None:
     folium.GeoJson(_drop_datetime_cols_for_folium(aoi_gdf).to_json(), name="AOI", style_function=lambda x: {"fillOpacity": 0.08, "weight": 2}).add_to(m)
 
+capa_mun = capa_municipios_geojson(df_latest, vistas.version)
+if capa_mun is not None:
+    capa_json, capa_name_col, capa_vmax = capa_mun
+    cmap = branca.colormap.LinearColormap(["#ffffcc", "#fd8d3c", "#bd0026"], vmin=0, vmax=max(capa_vmax, 1.0), caption="Inversión total (COP)")
+    folium.GeoJson(
+        capa_json,
+        name="Inversión por municipio",
+        style_function=lambda f: {
+            "fillColor": cmap(f["properties"]["inversion_total"]) if f["properties"]["inversion_total"] > 0 else "#00000000",
+            "fillOpacity": 0.55,
+            "color": "#555555",
+            "weight": 0.6,
+        },
+        tooltip=folium.GeoJsonTooltip(
+            fields=[capa_name_col, "inversion_txt", "n_proyectos", "avance_prom"],
+            aliases=["Municipio", "Inversión", "Proyectos", "Avance promedio (%)"],
+        ),
+    ).add_to(m)
+    cmap.add_to(m)
+
 if os.path.isdir(GEOM_DIR):
     for fn in os.listdir(GEOM_DIR):
         if fn.endswith("_last.geojson"):
@@ -707,20 +1093,15 @@ if os.path.isdir(GEOM_DIR):
             except Exception:
                 pass
 
-pts = {}
-if os.path.exists(GEO_CSV) and not df_latest.empty:
-    g = pd.read_csv(GEO_CSV)
-    if "timestamp" in g.columns:
-        g["timestamp"] = pd.to_datetime(g["timestamp"], errors="coerce")
-        g_last = g.sort_values("timestamp").drop_duplicates("username", keep="last")
-        pts = {r["username"]: (r.get("lon"), r.get("lat")) for _, r in g_last.iterrows()}
+pts = vistas.punto_por_usuario
 
 if not df_latest.empty:
     for _, r in df_latest.iterrows():
         u = r["username"]
         lon, lat = None, None
-        if u in pts and pd.notna(pts[u][0]) and pd.notna(pts[u][1]):
-            lon, lat = pts[u]
+        u_key = _clave(u)
+        if u_key in pts and pd.notna(pts[u_key][0]) and pd.notna(pts[u_key][1]):
+            lon, lat = pts[u_key]
         popup = folium.Popup(
             f"<b>{r.get('name','')}</b> ({u})"
             f"<br/>{r.get('proyecto_nombre','')}"